@@ -1,5 +1,6 @@
 import asyncio
 import functools
+import gzip
 import json
 import os
 import subprocess
@@ -9,7 +10,7 @@ import requests
 import yaml
 from requests.adapters import HTTPAdapter
 
-from globals import logger
+from globals import CLASH_PATH, CLASH_URL, logger
 from utils import get_retry_session
 
 
@@ -109,3 +110,16 @@ class Clash:
         if response.ok:
             return True
         return False
+
+
+def prepare_clash():
+    if os.path.exists(CLASH_PATH):
+        logger.info(f'clash binary exists: {CLASH_PATH}')
+    else:
+        logger.info(f'downloading clash binary from {CLASH_URL}')
+        data = requests.get(CLASH_URL).content
+        data = gzip.decompress(data)
+        with open(CLASH_PATH, 'wb') as fs:
+            fs.write(data)
+        os.chmod(CLASH_PATH, 0o755)
+    Clash.bin_path = CLASH_PATH
@@ -6,6 +6,7 @@ import io
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from urllib.parse import urlparse
@@ -15,11 +16,13 @@ import yaml
 from colored import fg
 import debugpy
 
-from clash import Clash
+from clash import prepare_clash
 from globals import CACHE_DIR, CLASH_PATH, CLASH_URL, logger
+from probe import Coordinator, parse_address
+from profiler import Profiler
 from subscription import ProxiesFilter, Subscription
 from template import Template
-from utils import get_retry_session, is_path_writable
+from utils import get_retry_session, is_path_writable, write_config
 
 
 class MyFormatter(logging.Formatter):
@@ -72,6 +75,10 @@ parser.add_argument('-c', '--cache', help='using cache instead of re-download to
 parser.add_argument('-d', '--days', help='cache live time in days, 0 for eternal', default=30, type=int)
 parser.add_argument('-p', '--patterns', help='proxy name patterns for filtering', nargs='*')
 parser.add_argument("--debug", action="store_true")
+parser.add_argument('-w', '--workers', help='probe worker addresses like host:port, see worker.py', nargs='+', default=[])
+parser.add_argument('--local-workers', help='number of local probe workers to spawn', default=0, type=int)
+parser.add_argument('--authkey', help='authentication key shared with probe workers', default=os.environ.get('FORGE_AUTHKEY'))
+parser.add_argument('--profile', help='profile each stage with cProfile and tracemalloc into a run directory under the cache dir', action='store_true')
 # fmt: on
 args = parser.parse_args()
 
@@ -117,27 +124,38 @@ def load_config(url) -> dict:
     return config
 
 
-def prepare_clash():
-    if os.path.exists(CLASH_PATH):
-        logger.info(f'clash binary exists: {CLASH_PATH}')
+def init_coordinator():
+    """Return a probe coordinator, or `...` if no workers are used."""
+    if not args.workers and not args.local_workers:
+        return ...
+    if args.authkey is None:
+        if args.workers:
+            logger.error('--authkey or FORGE_AUTHKEY is required by remote workers')
+            sys.exit(1)
+        # local workers only, any random key will do
+        authkey = os.urandom(32)
     else:
-        logger.info(f'downloading clash binary from {CLASH_URL}')
-        data = requests.get(CLASH_URL).content
-        data = gzip.decompress(data)
-        with open(CLASH_PATH, 'wb') as fs:
-            fs.write(data)
-        os.chmod(CLASH_PATH, 0o755)
-    Clash.bin_path = CLASH_PATH
+        authkey = args.authkey.encode('utf-8')
+    coordinator = Coordinator([parse_address(worker) for worker in args.workers], authkey)
+    coordinator.spawn_local_workers(args.local_workers)
+    return coordinator
 
 
-async def main():
+async def main(coordinator: Coordinator = ...):
     # Make output directories
     [os.makedirs(Path(path).parent, exist_ok=True) for path in args.outputs]
     # Make sure the output paths are writable
     if not all([is_path_writable(path) for path in args.outputs]):
         sys.exit(1)
+    # init profiler
+    if args.profile:
+        run_dir = CACHE_DIR / 'profiles' / datetime.now().strftime('%Y%m%d-%H%M%S')
+        profiler = Profiler(run_dir)
+    else:
+        profiler = Profiler()
     # load configs
-    configs = [load_config(url) for url in args.subscriptions]
+    with profiler.stage('load'):
+        configs = [load_config(url) for url in args.subscriptions]
     prev_lens = [len(config['proxies']) for config in configs]
     # prepare clash
     prepare_clash()
@@ -150,7 +168,7 @@ async def main():
     [cache_subscription_config(subscription) for subscription in subscriptions]
 
     # Init filter
-    proxiesFilter = ProxiesFilter(args.patterns)
+    proxiesFilter = ProxiesFilter(args.patterns, profiler, coordinator)
     # filter proxies
     for subscription in subscriptions:
         logger.info(f'start filtering {subscription.id}')
@@ -168,12 +186,23 @@ async def main():
     # load templates
     templates = [Template(template) for template in args.templates]
     # fit template
-    configs = [template.fit(subscriptions) for template in templates]
+    with profiler.stage('fit'):
+        configs = [template.fit(subscriptions) for template in templates]
     # save fitted configs
-    for path, config in zip(args.outputs, configs):
-        with open(path, 'w') as fs:
-            logger.info(f'saving config {path}')
-            yaml.safe_dump(config, fs, allow_unicode=True)
+    with profiler.stage('dump'):
+        if profiler.enabled:
+            # serialize in-process, otherwise the profiler sees only waiting
+            written = list(map(write_config, args.outputs, configs))
+        else:
+            # serialize and write in parallel
+            max_workers = min(len(configs), os.cpu_count() or 1) or None
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                written = list(executor.map(write_config, args.outputs, configs))
+        for path, is_written in zip(args.outputs, written):
+            if is_written:
+                logger.info(f'saved config {path}')
+            else:
+                logger.info(f'config {path} unchanged, skip saving')
 
 
 if __name__ == '__main__':
@@ -184,4 +213,6 @@ if __name__ == '__main__':
         debugpy.breakpoint()
         print("break on this line")
 
-    asyncio.run(main())
+    # spawn local workers before the event loop starts, since they are forked
+    coordinator = init_coordinator()
+    asyncio.run(main(coordinator))
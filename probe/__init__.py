@@ -0,0 +1,313 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import socket
+import sys
+import time
+from multiprocessing.connection import Client, Listener
+
+from tqdm import tqdm
+
+from clash import Clash, prepare_clash
+from globals import logger
+from utils import get_egress_ip, get_tcp_port_picker
+
+
+def _start_clash(proxies: list[dict], port: int) -> Clash:
+    """Start a clash instance of proxies, with ports picked from `port` on."""
+    poll_timeout = 3
+
+    # form a simple temp clash config
+    tcp_port_picker = get_tcp_port_picker(port)
+    port, external_controller_port = [next(tcp_port_picker) for _ in range(2)]
+    config = {
+        'mixed-port': port,
+        'external-controller': f'127.0.0.1:{external_controller_port}',
+        'ipv6': True,
+        'mode': 'global',
+        'proxies': proxies,
+        'log-level': 'warning',
+    }
+    # start clash process
+    clash = Clash(config)
+    clash.run()
+    while poll_timeout != 0:
+        logger.info('waiting for clash initialization...')
+        if clash.is_ready:
+            break
+        time.sleep(1)
+        poll_timeout -= 1
+    else:
+        logger.error(f'clash initialization polling failed')
+        sys.exit(1)
+    return clash
+
+
+async def _ping(clash: Clash) -> list[str]:
+    """Return the names of the proxies responding to clash ping."""
+    ping_retry = 1
+
+    names = set()
+    while ping_retry != 0:
+        ping_responses = await clash.ping_all()
+        names |= set(
+            filter(lambda name: 'delay' in ping_responses[name].keys(), ping_responses)
+        )
+        ping_retry -= 1
+    return sorted(names)
+
+
+def _lookup_egress_ips(clash: Clash, names: list[str]) -> dict[str, str]:
+    local_proxy = {
+        'https': f'socks5://localhost:{clash.port}',
+        'http': f'socks5://localhost:{clash.port}',
+    }
+    egress_ips = {}
+    if logger.level == logging.getLevelName('DEBUG'):
+        for name in names:
+            if not clash.select('GLOBAL', name):
+                sys.exit(1)
+            egress_ips[name] = get_egress_ip(local_proxy)
+            logger.info(f'[egress] {name} {egress_ips[name]}')
+    else:
+        for name in tqdm(names, 'updating egress IPs'):
+            if not clash.select('GLOBAL', name):
+                sys.exit(1)
+            egress_ips[name] = get_egress_ip(local_proxy)
+    return egress_ips
+
+
+async def probe(proxies: list[dict], port=1024) -> dict[str, str]:
+    """
+
+    Probe proxies with a local clash instance, the clash ports are picked
+    from `port` on. Ping is used for pre-filtering, which relieves the egress
+    IP lookup.
+
+    return - `{name: egress IP}` of the reachable proxies
+    """
+    clash = _start_clash(proxies, port)
+    egress_ips = _lookup_egress_ips(clash, await _ping(clash))
+    del clash
+    return egress_ips
+
+
+async def ping(proxies: list[dict], port=1024) -> list[str]:
+    """Return the names of the reachable proxies."""
+    clash = _start_clash(proxies, port)
+    names = await _ping(clash)
+    del clash
+    return names
+
+
+async def lookup_egress_ips(proxies: list[dict], port=1024) -> dict[str, str]:
+    """Return `{name: egress IP}` of the proxies, which are assumed reachable."""
+    clash = _start_clash(proxies, port)
+    egress_ips = _lookup_egress_ips(clash, [proxy['name'] for proxy in proxies])
+    del clash
+    return egress_ips
+
+
+def fingerprint(proxy: dict) -> str:
+    """Stable fingerprint of a raw proxy, used to shard proxies across workers."""
+    data = json.dumps(proxy, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    """Parse 'host:port' into `(host, port)`."""
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+def serve(address: tuple[str, int], authkey: bytes, vantage: str = ..., port=1024):
+    """
+
+    Serve probe requests forever, each request runs a fresh clash instance.
+    The clash binary must be prepared by the caller.
+
+    The protocol is pickled dicts over `multiprocessing.connection`, which
+    authenticates peers by `authkey` before unpickling anything. A connection
+    carries exactly one request and its response:
+        - request: `{'command': 'ping' | 'egress', 'proxies': [raw proxies]}`
+        - response of ping: `{'vantage': vantage, 'reachable': [names]}`
+        - response of egress: `{'vantage': vantage, 'egress_ips': {name: IP}}`
+        - response of a failed request: `{'vantage': vantage, 'error': reason}`
+    """
+    if vantage == ...:
+        vantage = f'{socket.gethostname()}:{address[1]}'
+    with Listener(address, authkey=authkey) as listener:
+        logger.info(f'probe worker {vantage} listening on {address[0]}:{address[1]}')
+        while True:
+            try:
+                conn = listener.accept()
+            except multiprocessing.AuthenticationError:
+                logger.warning(f'rejected unauthenticated connection')
+                continue
+            with conn:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    continue
+                # a failed request must not kill the worker
+                try:
+                    command, proxies = request['command'], request['proxies']
+                    logger.info(f'{command} {len(proxies)} proxies')
+                    if command == 'ping':
+                        response = {'reachable': asyncio.run(ping(proxies, port))}
+                    elif command == 'egress':
+                        egress_ips = asyncio.run(lookup_egress_ips(proxies, port))
+                        response = {'egress_ips': egress_ips}
+                    else:
+                        raise ValueError(f'unknown command {command!r}')
+                except (Exception, SystemExit) as e:
+                    logger.error(f'request failed: {e!r}')
+                    response = {'error': repr(e)}
+                response['vantage'] = vantage
+                conn.send(response)
+
+
+class Coordinator:
+    """Distribute probing across workers, and gather their results."""
+
+    connect_timeout = 10
+    # clash port ranges of local workers are separated by this gap
+    local_port_gap = 100
+    local_port_base = 10000
+
+    def __init__(self, addresses: list[tuple[str, int]], authkey: bytes) -> None:
+        self.addresses = addresses
+        self.authkey = authkey
+        # local worker processes spawned by `spawn_local_workers`
+        self.processes: list[multiprocessing.Process] = []
+        # vantage names reported by workers, used to name failed ones
+        self.vantages: dict[tuple[str, int], str] = {}
+
+    def spawn_local_workers(self, n: int):
+        if n == 0:
+            return
+        # prepare clash once here, the forked workers share it
+        prepare_clash()
+        tcp_port_picker = get_tcp_port_picker()
+        for i in range(n):
+            address = ('127.0.0.1', next(tcp_port_picker))
+            process = multiprocessing.Process(
+                target=serve,
+                args=(
+                    address,
+                    self.authkey,
+                    f'local-{i}',
+                    self.local_port_base + i * self.local_port_gap,
+                ),
+                daemon=True,
+            )
+            process.start()
+            self.addresses.append(address)
+            self.processes.append(process)
+
+    def __del__(self):
+        for process in self.processes:
+            process.terminate()
+
+    def _connect(self, address: tuple[str, int]):
+        deadline = time.time() + self.connect_timeout
+        while True:
+            try:
+                return Client(address, authkey=self.authkey)
+            except ConnectionRefusedError:
+                # the worker may be still starting
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def _request(self, address: tuple[str, int], request: dict) -> dict:
+        """Return the response of the worker, errors are reported in it."""
+        try:
+            with self._connect(address) as conn:
+                conn.send(request)
+                response = conn.recv()
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+            vantage = self.vantages.get(address, f'{address[0]}:{address[1]}')
+            return {'vantage': vantage, 'error': repr(e)}
+        self.vantages[address] = response['vantage']
+        return response
+
+    async def _gather(self, command: str, shards: list[list[dict]]) -> list[dict]:
+        """Send each shard to the worker of the same index, skip empty ones."""
+        async def request(address, shard):
+            if not shard:
+                return ...
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self._request, address, {'command': command, 'proxies': shard}
+            )
+
+        return await asyncio.gather(
+            *[request(address, shard) for address, shard in zip(self.addresses, shards)]
+        )
+
+    async def probe(
+        self, proxies: list[dict]
+    ) -> tuple[dict[str, dict[str, bool]], dict[str, str]]:
+        """
+
+        Every worker pings all proxies, then the egress IP lookup of each
+        proxy is sharded across the workers reaching it. Failed workers are
+        left out of the reachability, and their egress shards are retried on
+        other workers. Exit if no worker pings successfully, or a reachable
+        proxy has no worker left for its egress IP lookup.
+
+        return - `(reachability, egress IPs)`, where
+            - reachability is `{name: {vantage: reachable}}` of the working
+              vantages
+            - egress IPs are `{name: egress IP}` of the reachable proxies
+        """
+        # ping from every vantage
+        responses = await self._gather('ping', [proxies] * len(self.addresses))
+        reachability = {proxy['name']: {} for proxy in proxies}
+        # a dict of {name: [indices of workers reaching it]}
+        reachers = {proxy['name']: [] for proxy in proxies}
+        for i, response in enumerate(responses):
+            vantage = response['vantage']
+            if 'error' in response:
+                logger.warning(f'probe worker {vantage} failed: {response["error"]}')
+                continue
+            reachable = set(response['reachable'])
+            for name in reachability:
+                reachability[name][vantage] = name in reachable
+                if name in reachable:
+                    reachers[name].append(i)
+        if all('error' in response for response in responses):
+            logger.error('no probe worker pinged successfully')
+            sys.exit(1)
+
+        # shard egress IP lookups across the reaching workers
+        egress_ips = {}
+        failed = set()
+        pending = [proxy for proxy in proxies if reachers[proxy['name']]]
+        while pending:
+            shards = [[] for _ in self.addresses]
+            for proxy in pending:
+                candidates = [i for i in reachers[proxy['name']] if i not in failed]
+                if not candidates:
+                    logger.error(f'no probe worker left for {proxy["name"]}')
+                    sys.exit(1)
+                shard = candidates[int(fingerprint(proxy), 16) % len(candidates)]
+                shards[shard].append(proxy)
+            responses = await self._gather('egress', shards)
+
+            # collect the failed shards for the next round
+            pending = []
+            for i, (shard, response) in enumerate(zip(shards, responses)):
+                if not shard:
+                    continue
+                if 'error' in response:
+                    logger.warning(
+                        f'probe worker {response["vantage"]} failed: {response["error"]}'
+                    )
+                    failed.add(i)
+                    pending += shard
+                    continue
+                egress_ips.update(response['egress_ips'])
+        return reachability, egress_ips
@@ -0,0 +1,142 @@
+import cProfile
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+from globals import logger
+
+
+class Profiler:
+    """
+
+    Profile pipeline stages with cProfile and tracemalloc. Each stage wrapped
+    by `stage` writes the following files into the run directory:
+        - `<index>-<stage>.prof`: raw cProfile stats, readable by `pstats`
+        - `<index>-<stage>.collapsed`: collapsed stacks in microseconds, usable
+          by flamegraph tools like `flamegraph.pl` or speedscope
+        - `<index>-<stage>.alloc.txt`: peak memory of the stage, and the top
+          allocations made during the stage and still held at its end
+
+    A profiler without run directory is disabled, `stage` is a no-op then.
+    """
+
+    top_allocations = 30
+    # allocations are grouped by their innermost line, deeper tracebacks only
+    # slow down the stage and skew its CPU profile
+    traceback_limit = 1
+    # prune stacks cheaper than this when collapsing, in seconds
+    min_stack_time = 1e-6
+
+    def __init__(self, run_dir=...) -> None:
+        self.run_dir = run_dir
+        # stage counter, used to keep the output files in order
+        self.count = 0
+        if self.enabled:
+            os.makedirs(run_dir, exist_ok=True)
+            logger.info(f'profiling into {run_dir}')
+
+    @property
+    def enabled(self):
+        return self.run_dir != ...
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+
+        Stages must not be nested, since only one cProfile profiler could be
+        active at a time.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self.count += 1
+        prefix = Path(self.run_dir) / f'{self.count:02d}-{name}'
+        profile = cProfile.Profile()
+        tracemalloc.start(self.traceback_limit)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self._dump(prefix, profile, snapshot, peak)
+
+    def _dump(
+        self,
+        prefix: Path,
+        profile: cProfile.Profile,
+        snapshot: tracemalloc.Snapshot,
+        peak: int,
+    ):
+        stats = pstats.Stats(profile)
+        stats.dump_stats(f'{prefix}.prof')
+
+        with open(f'{prefix}.collapsed', 'w') as fs:
+            for stack, time in self._collapse(stats).items():
+                # collapsed format counts in integers, use microseconds
+                count = round(time * 1e6)
+                if count > 0:
+                    fs.write(f'{stack} {count}\n')
+
+        snapshot = snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ]
+        )
+        statistics = snapshot.statistics('lineno')
+        with open(f'{prefix}.alloc.txt', 'w') as fs:
+            fs.write(f'peak: {peak / 1024:.1f} KiB\n')
+            fs.write(f'retained: {sum(s.size for s in statistics) / 1024:.1f} KiB\n')
+            fs.write(
+                '\nallocations still held at the end of the stage, short-lived '
+                'allocations are only reflected by the peak above:\n'
+            )
+            for statistic in statistics[: self.top_allocations]:
+                fs.write(f'{statistic}\n')
+
+        logger.info(
+            f'[profile] {prefix.name}: {stats.total_tt:.3f}s, peak {peak / 1024:.1f} KiB'
+        )
+
+    @classmethod
+    def _collapse(cls, stats: pstats.Stats) -> dict[str, float]:
+        """
+
+        Rebuild collapsed stacks from the caller-callee edges recorded by
+        cProfile. The time of a function called from several places is split
+        in proportion to each edge, recursive calls are cut off.
+
+        return - a dict of `{'root;...;leaf': self time in seconds}`
+        """
+        entries = stats.stats
+        callees = {}
+        for func, (_, _, _, _, callers) in entries.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, []).append((func, edge[3]))
+        roots = [func for func, entry in entries.items() if not entry[4]]
+
+        stacks = {}
+
+        def walk(func, path: list, ratio: float):
+            _, _, tt, ct, _ = entries[func]
+            path = path + [func]
+            key = ';'.join(pstats.func_std_string(f) for f in path)
+            stacks[key] = stacks.get(key, 0) + tt * ratio
+            for callee, edge_ct in callees.get(func, []):
+                callee_ct = entries[callee][3]
+                if callee in path or callee_ct == 0:
+                    continue
+                if edge_ct * ratio < cls.min_stack_time:
+                    continue
+                walk(callee, path, ratio * edge_ct / callee_ct)
+
+        for root in roots:
+            walk(root, [], 1)
+        return stacks
@@ -1,24 +1,32 @@
 import asyncio
-import logging
-import sys
-import time
 from ipaddress import ip_address
 
 import yaml
-from tqdm import tqdm
 
-from clash import Clash
 from globals import logger
-from utils import convert_host_to_ip, get_egress_ip, get_tcp_port_picker
+from probe import Coordinator, probe
+from profiler import Profiler
+from utils import convert_host_to_ip
 
 from .proxy import Proxy
 
 
 class ProxiesFilter:
-    def __init__(self, patterns: list[str] = ...) -> None:
+    def __init__(
+        self,
+        patterns: list[str] = ...,
+        profiler: Profiler = ...,
+        coordinator: Coordinator = ...,
+    ) -> None:
         # list of str patterns used to filter by name
         self.patterns = patterns
 
+        # profiler wrapping each filtering stage, disabled by default
+        self.profiler = profiler if profiler != ... else Profiler()
+
+        # coordinator of probe workers, probe locally if not given
+        self.coordinator = coordinator
+
         # a dict of {'checkpoint description': count} as a log of filtering
         self.count_log = {}
 
@@ -46,73 +54,35 @@ class ProxiesFilter:
         self.count_log['after pattern filtering'] = len(ret)
         return ret
 
-    @staticmethod
-    async def _update_egress_ips(proxies: list[Proxy]):
+    async def _update_egress_ips(self, proxies: list[Proxy]):
         """
 
         As a result, only the proxies with valid egress IPs are updated.
         """
-        poll_timeout = 3
-        ping_retry = 1
-
-        # form a simple temp clash config
         raw_proxies = [proxy.raw for proxy in proxies]
-        tcp_port_picker = get_tcp_port_picker()
-        port, external_controller_port = [next(tcp_port_picker) for _ in range(2)]
-        config = {
-            'mixed-port': port,
-            'external-controller': f'127.0.0.1:{external_controller_port}',
-            'ipv6': True,
-            'mode': 'global',
-            'proxies': raw_proxies,
-            'log-level': 'warning',
-        }
-        # start clash process
-        clash = Clash(config)
-        clash.run()
-        while poll_timeout != 0:
-            logger.info('waiting for clash initialization...')
-            if clash.is_ready:
-                break
-            time.sleep(1)
-            poll_timeout -= 1
-        else:
-            logger.error(f'clash initialization polling failed')
-            sys.exit(1)
-
-        # using ping for pre-filtering, which will relieve the egress IP
-        # getting process
-        names = set()
-        while ping_retry != 0:
-            ping_responses = await clash.ping_all()
-            names |= set(
-                filter(
-                    lambda name: 'delay' in ping_responses[name].keys(), ping_responses
-                )
-            )
-            ping_retry -= 1
-
         # form a name-proxy dict for fast query
         querier = dict(((proxy['name'], proxy) for proxy in proxies))
-        # updating egress IPs
-        local_proxy = {
-            'https': f'socks5://localhost:{clash.port}',
-            'http': f'socks5://localhost:{clash.port}',
-        }
-        if logger.level == logging.getLevelName('DEBUG'):
-            for name in sorted(names):
-                if not clash.select('GLOBAL', name):
-                    sys.exit(1)
-                egress_ip = get_egress_ip(local_proxy)
-                querier[name].egress_ip = egress_ip
-                logger.info(f'[egress] {name} {egress_ip}')
-        else:
-            for name in tqdm(sorted(names), 'updating egress IPs'):
-                if not clash.select('GLOBAL', name):
-                    sys.exit(1)
-                egress_ip = get_egress_ip(local_proxy)
+
+        # probe locally
+        if self.coordinator == ...:
+            egress_ips = await probe(raw_proxies)
+            for name, egress_ip in egress_ips.items():
                 querier[name].egress_ip = egress_ip
-        del clash
+            return proxies
+
+        # probe by workers, and merge the per-vantage results
+        reachability, egress_ips = await self.coordinator.probe(raw_proxies)
+        for name, egress_ip in egress_ips.items():
+            querier[name].egress_ip = egress_ip
+        for name, vantages in reachability.items():
+            querier[name].reachability = vantages
+
+        # log reachability counts of each vantage
+        vantages = sorted({v for vantages in reachability.values() for v in vantages})
+        for vantage in vantages:
+            self.count_log[f'reachable from {vantage}'] = sum(
+                r.get(vantage, False) for r in reachability.values()
+            )
         return proxies
 
     async def _filter_by_ingress_ip(self, proxies: list[dict]):
@@ -160,6 +130,14 @@ class ProxiesFilter:
         # update egress IPs
         proxies = await self._update_egress_ips(proxies)
 
+        # keep proxies reachable from any vantage
+        if self.coordinator != ...:
+            proxies = self._filter(
+                proxies,
+                lambda proxy: any(proxy.reachability.values()),
+                'unreachable from all vantages',
+            )
+
         # filter out proxies with empty egress IPs
         proxies = self._filter(
             proxies, lambda proxy: proxy.egress_ip != ..., 'empty egress IP'
@@ -207,13 +185,16 @@ class ProxiesFilter:
             4. are duplicated in both ingress and egress IPs
         """
         # filter by ingress ip
-        proxies = await self._filter_by_ingress_ip(proxies)
+        with self.profiler.stage('filter-ingress-ip'):
+            proxies = await self._filter_by_ingress_ip(proxies)
 
         # filter by egress ip
-        proxies = await self._filter_by_egress_ip(proxies)
+        with self.profiler.stage('filter-egress-ip'):
+            proxies = await self._filter_by_egress_ip(proxies)
 
         # filter out proxies that duplicated in both ingress and egress IPs
-        proxies = self._filter_duplicated(proxies)
+        with self.profiler.stage('filter-duplicated'):
+            proxies = self._filter_duplicated(proxies)
 
         return [proxy.raw for proxy in proxies]
 
@@ -222,7 +203,8 @@ class ProxiesFilter:
         self.count_log = {}
 
         # filter by proxy name patterns
-        proxies = self._filter_by_patterns(proxies)
+        with self.profiler.stage('filter-patterns'):
+            proxies = self._filter_by_patterns(proxies)
 
         # filter by IP
         proxies = await self._filter_by_ip(proxies)
@@ -8,6 +8,8 @@ class Proxy:
         self.raw = raw
         self.ingress_ip: str = ...
         self.egress_ip: str = ...
+        # a dict of {vantage: reachable}, filled by probe workers
+        self.reachability: dict[str, bool] = {}
 
     def __getitem__(self, key):
         return self.raw[key]
@@ -22,6 +24,8 @@ class Proxy:
         obj = copy.deepcopy(self.raw)
         obj['ingress-ip'] = self.ingress_ip if self.ingress_ip != ... else ''
         obj['egress-ip'] = self.egress_ip if self.egress_ip != ... else ''
+        if self.reachability:
+            obj['reachability'] = self.reachability
         return yaml.safe_dump(obj, allow_unicode=True)
 
     @staticmethod
@@ -1,9 +1,13 @@
 import asyncio
+import hashlib
+import os
 import socket
+import tempfile
 from ipaddress import ip_address
 from pathlib import Path
 
 import requests
+import yaml
 from requests.adapters import HTTPAdapter
 
 from globals import logger
@@ -56,17 +60,57 @@ def get_tcp_port_picker(port=1024):
 def is_path_writable(path):
     """
 
-    Warning: This test may override the file of the given path.
+    The file itself is left untouched, since clients may be reading it. As
+    outputs are replaced by renaming, it's the parent directory that needs to
+    be writable, after resolving symlinks as `write_config` does.
     """
     path = Path(path)
-    if Path(path).is_dir():
+    if path.is_dir():
         logger.error(f'output path {path} is a directory')
         return False
-    with open(path, 'w') as fs:
-        result = fs.writable()
-        if not result:
-            logger.error(f'non-writable output path {path}')
-        return result
+    if not os.access(path.resolve().parent, os.W_OK):
+        logger.error(f'non-writable output path {path}')
+        return False
+    return True
+
+
+def write_config(path, config: dict) -> bool:
+    """
+
+    Dump config to path as YAML atomically, via a temp file in the same
+    directory and a rename. Skip writing if the content hash matches the
+    existing file, so that clients watching it are not reloaded for nothing.
+
+    return - whether the file is written
+    """
+    # write through symlinks, otherwise the rename replaces the link itself
+    path = Path(path).resolve()
+    data = yaml.safe_dump(config, allow_unicode=True).encode('utf-8')
+    try:
+        with open(path, 'rb') as fs:
+            if hashlib.sha256(fs.read()).digest() == hashlib.sha256(data).digest():
+                return False
+        mode = path.stat().st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    temp = tempfile.NamedTemporaryFile(
+        'wb', dir=path.parent, prefix=f'.{path.name}.', delete=False
+    )
+    try:
+        with temp:
+            temp.write(data)
+            temp.flush()
+            os.fsync(temp.fileno())
+        # temp files are created with 0o600, keep the mode of the old one
+        os.chmod(temp.name, mode)
+        os.replace(temp.name, path)
+    except BaseException:
+        os.remove(temp.name)
+        raise
+    return True
 
 
 async def nslookup(host):
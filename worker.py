@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+
+from clash import prepare_clash
+from globals import CACHE_DIR, logger
+from probe import parse_address, serve
+
+# Initiate logger
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+logger.addHandler(handler)
+logger.setLevel(os.environ.get('LOGLEVEL', 'INFO').upper())
+
+# Make cache directory
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+# Parse arguments
+parser = argparse.ArgumentParser(description='probe worker serving main.py')
+# fmt: off
+parser.add_argument('-l', '--listen', help='listening address like host:port', default='0.0.0.0:6000')
+parser.add_argument('--authkey', help='authentication key shared with the coordinator', default=os.environ.get('FORGE_AUTHKEY'))
+parser.add_argument('--vantage', help='name of this vantage point, default to hostname:port', default=...)
+# fmt: on
+args = parser.parse_args()
+
+
+if __name__ == '__main__':
+    if args.authkey is None:
+        parser.error('--authkey or FORGE_AUTHKEY is required')
+    prepare_clash()
+    serve(parse_address(args.listen), args.authkey.encode('utf-8'), args.vantage)